@@ -0,0 +1,292 @@
+# for finding the tables on disk
+import os
+import re
+import sys
+
+# for the report
+import json
+
+# for some computations
+import numpy as np
+
+# the fast table reader
+from refine_06 import read_table
+
+# This script analyzes the lens compensation tables of a
+# whole fleet of cameras. It expects a directory tree with
+# one directory per device, holding the table_B{0/1/2/3}.h
+# files written by geo_05.py (or any other table_*.h file).
+#
+# All tables are loaded into a single array of shape
+# (N, 4, 31, 41) and every statistic is computed over the
+# whole stack at once:
+#
+# - orientation consistency: the tables B0-B3 of a device
+#   should be basically identical (see the Readme). Each table
+#   is compared to the mean of the other tables of its device,
+#   also in all flipped orientations, to detect tables which
+#   are stored with a wrong orientation. Devices with a single
+#   table are reported as unchecked
+# - per channel gain statistics
+# - the fraction of cells at the limits of the table
+#   (clipped at 255, or below 32 which is undefined)
+# - outlier devices, which are far away from the median
+#   table of the fleet
+#
+# The results are written as a json-report.
+
+# the four orientations a table can be stored in:
+# as is, x-axis flipped, y-axis flipped, both flipped
+flips = [ ('none', np.s_[:,:,:,:]),
+          ('x',    np.s_[:,:,:,::-1]),
+          ('y',    np.s_[:,:,::-1,:]),
+          ('xy',   np.s_[:,:,::-1,::-1]) ]
+
+# collects all tables below root. Returns the stacked tables,
+# the device (directory) and bayerType (-1 if unknown) of each
+def load_tables(root):
+    names   = []
+    devices = []
+    types   = []
+    for path, dirs, files in os.walk(root):
+        dirs.sort()
+        for name in sorted(files):
+            if not (name.startswith('table_') and name.endswith('.h')):
+                continue
+            names.append(os.path.join(path,name))
+            devices.append(os.path.relpath(path,root))
+            match = re.match(r'table_B([0-3])\.h$',name)
+            types.append(int(match.group(1)) if match else -1)
+
+    tables = np.empty((len(names),4,31,41),dtype=np.uint8)
+    for i,name in enumerate(names):
+        tables[i] = read_table(name)
+    return tables, np.array(names), np.array(devices), np.array(types)
+
+# the statistics below are vectorized over the table stack,
+# but are computed in chunks of tables so that the float
+# temporaries stay small for large fleets
+chunk = 512
+
+# sum of the tables of every device, computed for all devices at
+# once. index maps each table to its device (every device has at
+# least one table). The tables are sorted by device, so the sum of
+# a device is a segmented sum over the sorted stack - done for a
+# chunk of devices at a time. Returns the sums and the number
+# of tables per device
+def device_sums(tables,index,nDevices):
+    order  = np.argsort(index,kind='mergesort')
+    counts = np.bincount(index,minlength=nDevices)
+    starts = np.concatenate(([0],np.cumsum(counts)))
+    sums   = np.empty((nDevices,)+tables.shape[1:],dtype=np.float32)
+    for d in range(0,nDevices,chunk):
+        first, last = starts[d], starts[min(d+chunk,nDevices)]
+        part = tables[order[first:last]].astype(np.float32)
+        sums[d:d+chunk] = np.add.reduceat(part,starts[d:min(d+chunk,nDevices)]-first,axis=0)
+    return sums, counts
+
+# compares every table to the mean of the other tables of its
+# device, in all four orientations. The table itself is left out
+# of the reference - otherwise a flipped table pulls the reference
+# towards itself (with four tables per device, by a quarter).
+# A flipped orientation only wins if it is better by more than
+# margin (LSB) - nearly symmetric tables would otherwise flip around
+# with the noise. Tables of devices with a single table can not be
+# checked. Returns the mean absolute deviation (LSB) in the best
+# orientation, the index of the best orientation, the largest
+# deviation of a single cell and whether the table was checked
+def orientation_consistency(tables,sums,counts,index,margin=0.25):
+    meanDev = np.zeros(tables.shape[0])
+    best    = np.zeros(tables.shape[0],dtype=int)
+    maxDev  = np.zeros(tables.shape[0])
+    checked = counts[index]>1
+
+    for i in range(0,tables.shape[0],chunk):
+        part      = tables[i:i+chunk].astype(np.float32)
+        others    = np.maximum(counts[index[i:i+chunk]]-1,1).astype(np.float32)
+        reference = (sums[index[i:i+chunk]]-part)/others[:,np.newaxis,np.newaxis,np.newaxis]
+
+        deviation = np.empty((len(flips),part.shape[0]))
+        for f,(name,flip) in enumerate(flips):
+            deviation[f] = np.abs(part[flip]-reference).mean(axis=(1,2,3))
+        partBest = np.where(deviation[1:].min(axis=0)<deviation[0]-margin,
+                            deviation[1:].argmin(axis=0)+1,0)
+        partBest[~checked[i:i+chunk]] = 0
+
+        unflipped = part.copy()
+        for f,(name,flip) in enumerate(flips):
+            unflipped[partBest==f] = part[flip][partBest==f]
+
+        best[i:i+chunk]    = partBest
+        meanDev[i:i+chunk] = deviation[partBest,np.arange(part.shape[0])]
+        maxDev[i:i+chunk]  = np.abs(unflipped-reference).max(axis=(1,2,3))
+
+    meanDev[~checked] = 0.0
+    maxDev[~checked]  = 0.0
+    return meanDev, best, maxDev, checked
+
+# gain statistics per table and color channel (gain 1.0 = 32)
+def gain_statistics(tables):
+    stats = { 'min':  tables.min(axis=(2,3))/32.0,
+              'max':  tables.max(axis=(2,3))/32.0,
+              'mean': np.empty(tables.shape[:2]),
+              'std':  np.empty(tables.shape[:2]) }
+    for i in range(0,tables.shape[0],chunk):
+        gains = tables[i:i+chunk]/np.float32(32.0)
+        stats['mean'][i:i+chunk] = gains.mean(axis=(2,3))
+        stats['std'][i:i+chunk]  = gains.std(axis=(2,3))
+    return stats
+
+# fraction of cells per table and channel which are at the
+# limit of the table (255) or in the undefined range (<32)
+def clipped_fractions(tables):
+    return { 'at255':   (tables==0xff).mean(axis=(2,3)),
+             'below32': (tables<0x20).mean(axis=(2,3)) }
+
+# devices whose mean table is far away from the median table
+# of the fleet. The difference of a device to the median is split
+# into a gain offset per channel (mean difference, LSB) and the
+# remaining difference in shape (rms, LSB). Both are scored with
+# the modified z-score (median absolute deviation), which is robust
+# against the outliers themselves. The median absolute deviation
+# is not allowed to drop below madFloor (LSB): the tables are
+# rounded to full LSBs, and for a tight fleet the median absolute
+# deviation would otherwise collapse and flag normal devices.
+# Returns the rms distance, the largest z-score and the outliers
+def outlier_devices(means,threshold=3.5,madFloor=0.5):
+    deviation = means-np.median(means,axis=0)
+    distance  = np.sqrt((deviation**2).mean(axis=(1,2,3)))
+    offset    = deviation.mean(axis=(2,3))
+    shape     = np.sqrt(((deviation-offset[:,:,np.newaxis,np.newaxis])**2).mean(axis=(1,2,3)))
+
+    def modified_zscore(values):
+        center = np.median(values,axis=0)
+        mad    = np.maximum(np.median(np.abs(values-center),axis=0),madFloor)
+        return 0.6745*(values-center)/mad
+
+    zscore = np.maximum(np.abs(modified_zscore(offset)).max(axis=1),
+                        modified_zscore(shape))
+    return distance, zscore, zscore>threshold
+
+# a fleet of simulated devices with a single lens model: every
+# device is the base table with a random overall gain (relative
+# standard deviation spread), rounded to table entries. Such a
+# fleet should give (nearly) no outliers
+def simulated_fleet(base,nDevices=500,tablesPerDevice=4,spread=0.01,seed=0):
+    random  = np.random.RandomState(seed)
+    gains   = 1.0+spread*random.randn(nDevices)
+    tables  = np.round(base[np.newaxis].astype(float)*gains[:,np.newaxis,np.newaxis,np.newaxis])
+    tables  = np.repeat(tables.clip(0x00,0xff).astype(np.uint8),tablesPerDevice,axis=0)
+    devices = np.repeat(np.array(['sim%04d'%d for d in range(0,nDevices)]),tablesPerDevice)
+    return tables, devices
+
+# all of the above, gathered in a dictionary ready to be
+# written as json
+def analyze(tables,names,devices,types,tolerance=1.0,threshold=3.5):
+    deviceNames, index = np.unique(devices,return_inverse=True)
+    sums, counts = device_sums(tables,index,len(deviceNames))
+    means = sums/counts[:,np.newaxis,np.newaxis,np.newaxis]
+
+    meanDev, best, maxDev, checked = orientation_consistency(tables,sums,counts,index)
+    stats   = gain_statistics(tables)
+    clipped = clipped_fractions(tables)
+    distance, zscore, outlier = outlier_devices(means,threshold)
+
+    consistent = checked & (best==0) & (meanDev<=tolerance)
+
+    channels = ['R','Gr','Gb','B']
+    def perChannel(values):
+        return dict(zip(channels,np.round(values,4).tolist()))
+
+    report = { 'tables':  len(names),
+               'devices': len(deviceNames),
+               'fleet': {
+                   'consistent_tables':  int(consistent.sum()),
+                   'flipped_tables':     int((best!=0).sum()),
+                   'unchecked_tables':   int((~checked).sum()),
+                   'gain_mean':          perChannel(stats['mean'].mean(axis=0)),
+                   'gain_min':           perChannel(stats['min'].min(axis=0)),
+                   'gain_max':           perChannel(stats['max'].max(axis=0)),
+                   'fraction_at255':     perChannel(clipped['at255'].mean(axis=0)),
+                   'fraction_below32':   perChannel(clipped['below32'].mean(axis=0)),
+                   'outlier_devices':    deviceNames[outlier].tolist() },
+               'per_device': [],
+               'per_table':  [] }
+
+    for d,name in enumerate(deviceNames):
+        report['per_device'].append({
+            'device':   name,
+            'tables':   int(counts[d]),
+            'distance': round(float(distance[d]),3),
+            'zscore':   round(float(zscore[d]),3),
+            'outlier':  bool(outlier[d]) })
+
+    for i,name in enumerate(names):
+        report['per_table'].append({
+            'file':             name,
+            'device':           devices[i],
+            'bayerType':        int(types[i]),
+            'orientation':      flips[best[i]][0] if checked[i] else 'unchecked',
+            'mean_deviation':   round(float(meanDev[i]),3) if checked[i] else None,
+            'max_deviation':    round(float(maxDev[i]),3) if checked[i] else None,
+            'consistent':       bool(consistent[i]),
+            'gain_mean':        perChannel(stats['mean'][i]),
+            'gain_std':         perChannel(stats['std'][i]),
+            'fraction_at255':   perChannel(clipped['at255'][i]),
+            'fraction_below32': perChannel(clipped['below32'][i]) })
+
+    return report
+
+####### here the fun part starts! #####################################
+if __name__ == '__main__':
+
+    ####### Settings ##################
+
+    # directory with one subdirectory per device
+    # (can also be given on the command line)
+    root       = 'example_results'
+
+    # where to write the report
+    reportName = 'fleet_report.json'
+
+    # mean deviation (LSB) from the device mean up
+    # to which a table counts as consistent
+    tolerance  = 1.0
+
+    # modified z-score above which a device is an outlier
+    threshold  = 3.5
+
+    # check the outlier detection on a simulated fleet
+    # of a single lens model first
+    selfCheck  = True
+
+    ###################################
+
+    if len(sys.argv)>1:
+        root = sys.argv[1]
+    if len(sys.argv)>2:
+        reportName = sys.argv[2]
+
+    tables, names, devices, types = load_tables(root)
+    print 'Loaded',tables.shape[0],'tables of',len(np.unique(devices)),'devices'
+
+    # the simulated fleet is built around the median table
+    if selfCheck:
+        simTables, simDevices = simulated_fleet(np.round(np.median(tables,axis=0)))
+        simReport = analyze(simTables,simDevices,simDevices,-np.ones(len(simDevices),dtype=int),
+                            tolerance,threshold)
+        print 'Simulated fleet of',simReport['devices'],'devices with 1% gain spread:',\
+              len(simReport['fleet']['outlier_devices']),'outliers'
+
+    report = analyze(tables,names,devices,types,tolerance,threshold)
+    print 'Consistent tables:',report['fleet']['consistent_tables']
+    print 'Flipped tables:',report['fleet']['flipped_tables']
+    print 'Unchecked tables (single table devices):',report['fleet']['unchecked_tables']
+    print 'Outlier devices:',report['fleet']['outlier_devices']
+
+    with open(reportName,'w') as file:
+        json.dump(report,file,indent=1,sort_keys=True)
+    print 'Report written to',reportName
+
+    print
+    print '... done.'
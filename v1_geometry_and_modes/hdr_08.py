@@ -0,0 +1,239 @@
+# for stream handling
+import io
+
+# need to wait a few secs
+from time import sleep, time
+
+# for some computations
+import numpy as np
+
+# the reduction to table resolution and the table i/o
+from refine_06 import reduce_to_table, save_table
+
+# structure to read out raw image information
+# from https://picamera.readthedocs.io/en/release-1.13/_modules/picamera/array.html#PiBayerArray
+import ctypes as ct
+class BroadcomRawHeader(ct.Structure):
+    _fields_ = [
+        ('name',          ct.c_char * 32),
+        ('width',         ct.c_uint16),
+        ('height',        ct.c_uint16),
+        ('padding_right', ct.c_uint16),
+        ('padding_down',  ct.c_uint16),
+        ('dummy',         ct.c_uint32 * 6),
+        ('transform',     ct.c_uint16),
+        ('format',        ct.c_uint16),
+        ('bayer_order',   ct.c_uint8),
+        ('bayer_format',  ct.c_uint8),
+        ]
+
+# This script computes a scene-adaptive lens compensation
+# table for the "semi-HDR" security camera application
+# (see the Readme in the top directory): areas of the scene
+# in the shadows get gains larger than 1.0.
+#
+# A single raw exposure is not good enough for this - the
+# highlights clip and the shadows are noisy, and both
+# corrupt the gains. So a bracket of raw exposures is taken
+# instead. Each raw image is reduced to table resolution as
+# soon as it arrives and is discarded afterwards; only the
+# weighted sums per table cell are kept. When the last
+# exposure is in, the table is computed from these sums -
+# there is no second pass over the image data.
+
+# level (10 bit) above which a pixel is considered clipped
+clipLevel = 1000
+
+# where the position in a Bayer quad (first index x,
+# second index y) ends up in the color planes, for the four
+# bayerTypes - the same as in readRaw() of geo_05.py
+bayerQuads = {0: [(0,0),(0,1),(1,0),(1,1)],
+              1: [(0,1),(0,0),(1,1),(1,0)],
+              2: [(1,1),(1,0),(0,1),(0,0)],
+              3: [(1,0),(1,1),(0,0),(0,1)]}
+
+# reads the raw part of a v1-camera jpg and sorts it into
+# the color planes. Same result as readRaw() in geo_05.py,
+# but the unpacking of the 10 bit values is done in one go
+def readRaw(data):
+
+    # check again for header
+    assert data[:4] == b'BRCM'
+
+    _header = BroadcomRawHeader.from_buffer_copy(
+            data[176:176 + ct.sizeof(BroadcomRawHeader)])
+    bayerType = _header.bayer_order
+
+    # 5 bytes hold 4 pixels: the upper 8 bits of each
+    # pixel, followed by a byte with the lower 2 bits
+    data = np.frombuffer(data, dtype=np.uint8, offset=32768)
+    data = data.reshape((1952, 3264))[:1944, :3240].reshape((1944, 648, 5))
+    shift = np.array([6,4,2,0],dtype=np.uint8)
+    data = (data[:,:,:4].astype(np.uint16) << 2) | ((data[:,:,4:] >> shift) & 0b11)
+
+    # we get the data as [y,x], need it as [x,y]
+    data = data.reshape((1944, 2592)).transpose()
+
+    cplane = np.empty((data.shape[0]//2,data.shape[1]//2,4), dtype=data.dtype)
+    for c,(x,y) in enumerate(bayerQuads[bayerType]):
+        cplane[:,:,c] = data[x::2, y::2]
+
+    return cplane, bayerType
+
+# accumulates a bracket of raw exposures at table resolution.
+# Each cell of each exposure gets a weight which is highest
+# for medium signal levels (hat function) and grows with
+# exposure time (less noise relative to the signal); cells with
+# clipped pixels get no weight at all. The radiance per cell
+# is than the weighted mean of signal/exposure time.
+class BracketFusion(object):
+
+    def __init__(self,blackLevel=16):
+        self.blackLevel = blackLevel
+        self.sum        = None
+        self.weights    = None
+
+        # the shortest exposure is the fallback for cells
+        # which are clipped in all exposures
+        self.shortest   = None
+        self.fallback   = None
+        self.bayerType  = None
+
+    # add a single raw image taken with the given exposure
+    # time (in us). Only table sized arrays are kept.
+    def add(self,data,exposure):
+        cplane, bayerType = readRaw(data)
+        clipped = reduce_to_table(cplane>=clipLevel,bayerType,32)
+        level   = reduce_to_table(cplane,bayerType,32)
+        level   = ((level-self.blackLevel)/(1023.0-self.blackLevel)).clip(0.0,1.0)
+
+        radiance = level/exposure
+        weight   = np.minimum(level,1.0-level)*exposure
+        weight[clipped>0.001] = 0.0
+
+        if self.sum is None:
+            self.sum       = np.zeros_like(radiance)
+            self.weights   = np.zeros_like(radiance)
+            self.bayerType = bayerType
+        self.sum     += weight*radiance
+        self.weights += weight
+
+        if self.shortest is None or exposure<self.shortest:
+            self.shortest = exposure
+            self.fallback = radiance
+
+    # the fused radiance per cell, in table format
+    def radiance(self):
+        return np.where(self.weights>0,
+                        self.sum/np.maximum(self.weights,1e-12),
+                        self.fallback)
+
+    # the lens compensation table from the fused radiance,
+    # computed as in calc_table() of geo_05.py
+    def table(self,scaler=32,equalize=False):
+        raw = self.radiance()
+        rawMax = raw.max(axis=(1,2))
+        if equalize:
+            rawMax[:] = rawMax.max()
+        table = scaler*np.divide(rawMax[:,np.newaxis,np.newaxis],raw,
+                                 out=np.full_like(raw,0xff),where=raw>0)
+        return table.clip(0x00,0xff).astype(np.uint8)
+
+# takes a bracket of raw exposures around the current auto
+# exposure and fuses them into a table. stops are the
+# exposure steps relative to the auto exposure, in EV
+def capture_bracket(camera,stops,blackLevel=16,settle=0.5):
+    fusion = BracketFusion(blackLevel)
+
+    base = camera.exposure_speed
+    camera.exposure_mode = 'off'
+    for stop in stops:
+        camera.shutter_speed = int(base*2.0**stop)
+        sleep(settle)
+
+        # the camera rounds the exposure time, so
+        # we read back what was actually used
+        exposure = camera.exposure_speed
+        stream = io.BytesIO()
+        camera.capture(stream, format='jpeg', bayer=True)
+        fusion.add(stream.getvalue()[-6404096:],exposure)
+
+    # give control back to the auto exposure
+    camera.shutter_speed = 0
+    camera.exposure_mode = 'auto'
+    return fusion
+
+####### here the fun part starts! #####################################
+if __name__ == '__main__':
+
+    ####### Settings ##################
+
+    # use the simulated camera instead of the real one
+    simulate   = True
+
+    # exposure bracket, in EV relative to the auto exposure
+    stops      = [-2,-1,0,1,2]
+
+    # gain of the brightest cell (32 = 1.0) - a larger
+    # value like 64 gives a sensitivity boost
+    scaler     = 64
+
+    # whitebalance with lens compensation
+    equalize   = False
+
+    # black level of the raw data (10 bit)
+    blackLevel = 16
+
+    # seconds between table refreshs and number of
+    # refreshs - None runs forever
+    refresh    = 300
+    cycles     = None
+
+    tableName  = 'table_hdr.h'
+
+    ###################################
+
+    if simulate:
+        from simcam import SimulatedCamera as Camera
+        from simcam import planeWidth, planeHeight
+        settle  = 0
+        refresh = 0
+        cycles  = cycles or 2
+    else:
+        from picamera import PiCamera as Camera
+        settle  = 0.5
+
+    with Camera() as camera:
+
+        # the raw-routine assumes a full resolution image
+        camera.sensor_mode = 2
+        camera.awb_mode    = 'auto'
+
+        # in the simulation, the camera is looking at a scene
+        # with a sunlit part and a part in the shadows
+        if simulate:
+            scene = np.full((planeHeight,planeWidth),0.05)
+            scene[:,planeWidth//3:] = 1.0
+            camera.scene = scene
+
+        print 'Let the camera settle. Wait a few sec...'
+        sleep(4*settle)
+
+        count = 0
+        try:
+            while cycles is None or count<cycles:
+                start  = time()
+                fusion = capture_bracket(camera,stops,blackLevel,settle)
+                table  = fusion.table(scaler,equalize)
+                print 'Fused %d exposures in %.2f sec, gains %.2f - %.2f'\
+                      %(len(stops),time()-start,table.min()/32.0,table.max()/32.0)
+
+                camera.lens_shading_table = table
+                save_table(tableName,table)
+                count += 1
+                sleep(refresh)
+        except KeyboardInterrupt:
+            pass
+
+    print
+    print '... done.'
@@ -0,0 +1,173 @@
+# need to wait between the samples
+from time import sleep, time
+
+# for stream handling
+import io
+
+# for some computations
+import numpy as np
+
+# the measurement and table routines of the refinement loop
+from refine_06 import measure, target_gains, save_table, read_table
+
+# This script runs as a background monitor on a rig which
+# is looking at a flat field most of the time (for example
+# the illumination of a film scanner between frames). Over
+# hours, the illumination and the sensor drift, and a
+# lens compensation table computed once becomes stale.
+#
+# Instead of recalibrating from scratch, the monitor keeps
+# the camera open and periodically takes a cheap sample:
+# a jpeg captured from the video port (no mode switch),
+# decoded at 1/8 scale and reduced to table resolution.
+# From every sample the gains flattening the response are
+# estimated (see refine_06.py), and an exponential moving
+# average of these gains is kept per table cell.
+#
+# A new table is only pushed to the camera if the average
+# differs from the table in use by more than a given number
+# of LSBs in at least one cell - uploading a table
+# reconfigures the camera pipeline, so it should not be
+# done for every small noise-induced change.
+
+class DriftMonitor(object):
+
+    def __init__(self,camera,table,bayerType,weight=0.2,threshold=2,
+                 alpha=1.0,scaler=32,tableName=None):
+        self.camera    = camera
+        self.bayerType = bayerType
+        self.weight    = weight
+        self.threshold = threshold
+        self.alpha     = alpha
+        self.scaler    = scaler
+        self.tableName = tableName
+
+        # the table in use and the running average of the gains
+        self.table     = table
+        self.gains     = table.astype(float)
+        self.camera.lens_shading_table = table
+
+        self.samples   = 0
+        self.uploads   = 0
+
+    # take one sample, update the running average and push
+    # a new table if needed. Returns True if a table was pushed
+    def sample(self):
+        stream = io.BytesIO()
+        self.camera.capture(stream, format='jpeg', use_video_port=True)
+        response, clipped = measure(stream.getvalue(),self.bayerType)
+        valid = clipped<0.01
+
+        # the response was measured with the current table applied,
+        # so the gains estimated are absolute gains
+        gains = target_gains(self.table,response,valid,self.alpha,self.scaler)
+        self.gains += self.weight*(gains-self.gains)
+        self.samples += 1
+
+        # upload suppression: only push a table if at
+        # least one cell changed noticably
+        table  = (self.gains+0.5).astype(np.uint8)
+        change = np.abs(table.astype(int)-self.table.astype(int)).max()
+        if change<=self.threshold:
+            return False
+
+        self.table = table
+        self.camera.lens_shading_table = table
+        self.uploads += 1
+        if self.tableName:
+            save_table(self.tableName,table)
+        return True
+
+####### here the fun part starts! #####################################
+if __name__ == '__main__':
+
+    ####### Settings ##################
+
+    # use the simulated camera instead of the real one
+    simulate   = True
+
+    # table to start with (for example from refine_06.py)
+    # - if None, the monitor starts from a flat table
+    startName  = None
+
+    # the updated table is written here whenever it is pushed
+    tableName  = 'table_monitor.h'
+
+    # camera orientation
+    hflip      = True
+    vflip      = True
+
+    # seconds between samples, weight of a new sample in
+    # the moving average and the change in LSBs which
+    # triggers a table upload
+    interval   = 10
+    weight     = 0.2
+    threshold  = 2
+
+    # number of samples to take - None runs forever
+    cycles     = None
+
+    ###################################
+
+    if simulate:
+        from simcam import SimulatedCamera as Camera
+        from simcam import planeWidth, planeHeight
+        interval = 0
+        cycles   = cycles or 60
+    else:
+        from picamera import PiCamera as Camera
+
+    if   hflip==True and vflip==True:
+        bayerType = 3
+    elif hflip==False and vflip==True:
+        bayerType = 0
+    elif hflip==True and vflip==False:
+        bayerType = 2
+    else:
+        bayerType = 1
+
+    if startName:
+        table = read_table(startName)
+    else:
+        table = np.full((4,31,41),32,dtype=np.uint8)
+
+    with Camera(lens_shading_table=table) as camera:
+
+        # the measurement assumes that the full sensor is captured
+        camera.sensor_mode = 2
+        camera.resolution  = (2592,1944)
+        camera.hflip       = hflip
+        camera.vflip       = vflip
+
+        # freeze exposure and whitebalance
+        print 'Setting up camera. Wait a few sec...'
+        camera.awb_mode = 'auto'
+        sleep(0 if simulate else 2)
+        camera.shutter_speed = camera.exposure_speed
+        camera.exposure_mode = 'off'
+        awb_gains = camera.awb_gains
+        camera.awb_mode  = 'off'
+        camera.awb_gains = awb_gains
+
+        monitor = DriftMonitor(camera,table,bayerType,weight,threshold,tableName=tableName)
+
+        try:
+            while cycles is None or monitor.samples<cycles:
+                # in the simulation, the illumination slowly
+                # tilts from one side of the image to the other
+                if simulate:
+                    tilt = 0.05*np.sin(2*np.pi*monitor.samples/cycles)
+                    x = np.linspace(-1.0,1.0,planeWidth)
+                    camera.scene = np.tile(1.0+tilt*x,(planeHeight,1))
+
+                start  = time()
+                pushed = monitor.sample()
+                print 'Sample %d: %.2f sec%s'%(monitor.samples,time()-start,
+                                               ', table pushed' if pushed else '')
+                sleep(interval)
+        except KeyboardInterrupt:
+            pass
+
+    print 'Took %d samples, pushed %d tables'%(monitor.samples,monitor.uploads)
+    print
+    print '... done.'
@@ -0,0 +1,295 @@
+# for the archive and the sidecar file
+import os
+import json
+import struct
+import zlib
+
+# for reading the raw header
+import ctypes as ct
+
+# for some computations
+import cv2
+import numpy as np
+
+# the Bayer layout of the raw data and the table geometry
+from hdr_08 import BroadcomRawHeader, bayerQuads
+from refine_06 import orientation
+
+# This script builds a preview index for a directory of raw
+# captures (the jpeg-files with raw data appended, like the
+# raw_B*.jpg files of geo_05.py). Browsing such an archive
+# otherwise means decoding 6 MB of Bayer data per image.
+#
+# For every raw capture, the index holds
+# - a small false-color thumbnail (324x243, a jpeg)
+# - a shading map: the mean level of every color channel
+#   per table cell, in table format and orientation - this is
+#   what calc_table() computes a lens compensation table from
+# - a few numbers to choose calibration frames by: the
+#   orientation, the level of every channel and the fraction
+#   of clipped pixels
+#
+# Both the thumbnail and the shading map come out of a single
+# reduction of the Bayer planes, done right when the raw data
+# is unpacked: only the upper 8 bits of each pixel are used
+# (enough for averages over many pixels, once the offset of
+# the truncation is corrected), and the planes are padded to
+# the table grid as in calc_table() and averaged over blocks
+# of 4x4. Without the padding, this is already the
+# thumbnail; the shading map is the average over 8x8 of
+# these blocks.
+#
+# Everything is stored in a single sidecar file per directory,
+# '.previews', with a json-index at its beginning. Files which
+# did not change are not decoded again when the index is updated.
+#
+# Sidecar file layout: 'LSPV', length of the index (uint32),
+# the index (json, utf-8), the thumbnails and shading maps
+
+sidecarName = '.previews'
+
+# size of the raw data at the end of a capture
+rawSize     = 6404096
+
+# level (upper 8 bits) above which a pixel is considered clipped
+clipLevel   = 250
+
+# dropping the lower 2 bits truncates every pixel by 1.5 LSB
+# (10 bit) on average, i.e. 0.375 on the 8 bit scale. This is
+# added back to the block means
+truncation  = 0.375
+
+# returns the raw data of a capture, or None if
+# the file is not a capture with raw data
+def read_raw_part(fileName):
+    if os.path.getsize(fileName)<rawSize:
+        return None
+    with open(fileName,'rb') as file:
+        file.seek(-rawSize,os.SEEK_END)
+        data = file.read()
+    if data[:4]!=b'BRCM':
+        return None
+    return data
+
+# size of the Bayer planes, padded to the table grid (41x31
+# cells of 32x32 quads, see reduce_to_table() in refine_06.py)
+paddedSize  = (1312,992)
+
+# the full 10 bits (on the 8 bit scale) of single pixels of the
+# raw data, given as groups of 5 bytes [y,x//4,byte]
+def full_bits(raw,rows,cols):
+    cols  = np.asarray(cols)
+    upper = raw[rows,cols//4,cols%4]
+    lower = (raw[rows,cols//4,4] >> (6-2*(cols%4)).astype(np.uint8)) & 0b11
+    return upper+lower/4.0
+
+# unpacks the raw data and reduces the Bayer planes in one
+# go. Returns the planes padded to the table grid and averaged
+# over blocks of 4x4 quads (first index y, second x, 8 bit
+# scale), the same blocks without the padding, the fraction
+# of clipped pixels per block and the bayerType
+def reduce_raw(data):
+    _header = BroadcomRawHeader.from_buffer_copy(
+            data[176:176 + ct.sizeof(BroadcomRawHeader)])
+    bayerType = _header.bayer_order
+
+    # only the upper 8 bits are used - the fifth byte of
+    # every group of 5, holding the lower bits, is skipped
+    raw  = np.frombuffer(data, dtype=np.uint8, offset=32768)
+    raw  = raw.reshape((1952, 3264))[:1944, :3240].reshape((1944, 648, 5))
+    data = raw[:,:,:4].reshape((1944, 2592))
+
+    # the planes are padded at the same side as in calc_table(),
+    # by replicating the outermost row and column. Both paddings
+    # are multiples of 4, so the padding fills whole blocks. In
+    # the corner cells, a single replicated pixel makes up nearly
+    # a third of the cell - the replicated pixels are therefore
+    # taken with their full 10 bits
+    flipX, flipY = orientation(bayerType)
+    pad_x = paddedSize[0]-1296
+    pad_y = paddedSize[1]-972
+    left,right = (pad_x,0) if flipX else (0,pad_x)
+    top,bottom = (pad_y,0) if flipY else (0,pad_y)
+    edgeX = 0 if flipX else 1295
+    edgeY = 0 if flipY else 971
+    image = np.s_[top//4:top//4+243,left//4:left//4+324]
+    padX  = np.s_[:,:left//4] if flipX else np.s_[:,left//4+324:]
+    padY  = np.s_[:top//4,:] if flipY else np.s_[top//4+243:,:]
+
+    padded  = np.empty((paddedSize[1]//4,paddedSize[0]//4,4),dtype=np.float32)
+    clipped = np.empty((243,324,4),dtype=np.float32)
+    for c,(x,y) in enumerate(bayerQuads[bayerType]):
+        plane = data[y::2, x::2].reshape(243,4,324,4)
+        padded[image][:,:,c] = plane.mean(axis=(1,3))+truncation
+        clipped[:,:,c] = (plane>=clipLevel).mean(axis=(1,3))
+
+        row = full_bits(raw,2*edgeY+y,2*np.arange(1296)+x)
+        col = full_bits(raw,2*np.arange(972)+y,2*edgeX+x)
+        padded[padY][:,:,c] = np.pad(row,(left,right),'edge').reshape(-1,4).mean(axis=1)
+        padded[padX][:,:,c] = np.pad(col,(top,bottom),'edge').reshape(-1,4).mean(axis=1)[:,np.newaxis]
+
+    return padded, padded[image], clipped, bayerType
+
+# the shading map: the padded blocks averaged over 8x8 blocks per
+# table cell, with 10 bit scale (as in the raw data), in table
+# format and orientation
+def shading_map(padded,bayerType):
+    flipX, flipY = orientation(bayerType)
+    cells = padded.reshape(31,8,41,8,4).mean(axis=(1,3))
+    table = 4.0*cells.transpose(2,0,1)
+    if flipX:
+        table = table[:,:,::-1]
+    if flipY:
+        table = table[:,::-1,:]
+    return table
+
+# the false-color thumbnail: red, mean of both greens and
+# blue, black level removed, scaled to the brightest part
+# of the image and with a gamma applied
+def thumbnail(blocks,blackLevel=4):
+    rgb = np.dstack((blocks[:,:,0],0.5*(blocks[:,:,1]+blocks[:,:,2]),blocks[:,:,3]))
+    rgb = (rgb-blackLevel).clip(0.0,None)
+    rgb = np.power(rgb/max(np.percentile(rgb,99.5),1.0),1.0/2.2).clip(0.0,1.0)
+    return (255.0*rgb[:,:,::-1]+0.5).astype(np.uint8)
+
+# builds the preview of a single raw capture
+def build_preview(data):
+    padded, blocks, clipped, bayerType = reduce_raw(data)
+
+    ok, thumb = cv2.imencode('.jpg',thumbnail(blocks),[cv2.IMWRITE_JPEG_QUALITY,80])
+
+    # shading map, stored with 6 fractional bits
+    shading = shading_map(padded,bayerType)
+    shadingData = zlib.compress((64.0*shading+0.5).astype(np.uint16).tostring(),9)
+
+    level = shading.max(axis=(1,2))
+    info  = { 'bayerType': int(bayerType),
+              'level':     [round(float(v),1) for v in level],
+              'balance':   round(float(level.min()/level.max()),3),
+              'clipped':   [round(float(v),5) for v in clipped.mean(axis=(0,1))] }
+    return info, thumb.tostring(), shadingData
+
+# reads the index of a sidecar file - nothing else
+def read_index(directory):
+    fileName = os.path.join(directory,sidecarName)
+    if not os.path.exists(fileName):
+        return {}
+    with open(fileName,'rb') as file:
+        assert file.read(4)==b'LSPV', 'not a preview file'
+        size, = struct.unpack('<I',file.read(4))
+        return json.loads(file.read(size).decode('utf-8'))
+
+# reads a part (thumbnail or shading map) of a single
+# entry of the sidecar file
+def read_part(directory,entry,part):
+    offset, length = entry[part]
+    with open(os.path.join(directory,sidecarName),'rb') as file:
+        file.seek(4)
+        size, = struct.unpack('<I',file.read(4))
+        file.seek(8+size+offset)
+        return file.read(length)
+
+def read_thumbnail(directory,entry):
+    data = read_part(directory,entry,'thumbnail')
+    return cv2.imdecode(np.frombuffer(data,dtype=np.uint8),cv2.IMREAD_COLOR)
+
+def read_shading(directory,entry):
+    data = zlib.decompress(read_part(directory,entry,'shading'))
+    return np.frombuffer(data,dtype=np.uint16).reshape((4,31,41))/64.0
+
+# builds or updates the sidecar file of a directory. Only
+# new or changed captures are decoded. Returns the index
+def update_index(directory):
+    old   = read_index(directory)
+    index = {}
+    blobs = []
+    offset = 0
+    decoded = 0
+
+    for name in sorted(os.listdir(directory)):
+        fileName = os.path.join(directory,name)
+        if name==sidecarName or not os.path.isfile(fileName):
+            continue
+        stat = os.stat(fileName)
+
+        entry = old.get(name)
+        if entry and entry['size']==stat.st_size and entry['mtime']==stat.st_mtime:
+            # unchanged - copy the previous preview
+            thumb   = read_part(directory,entry,'thumbnail')
+            shading = read_part(directory,entry,'shading')
+            info    = dict((k,v) for k,v in entry.items()
+                           if k not in ('thumbnail','shading'))
+        else:
+            data = read_raw_part(fileName)
+            if data is None:
+                continue
+            info, thumb, shading = build_preview(data)
+            info['size']  = stat.st_size
+            info['mtime'] = stat.st_mtime
+            decoded += 1
+
+        info['thumbnail'] = (offset,len(thumb))
+        info['shading']   = (offset+len(thumb),len(shading))
+        offset += len(thumb)+len(shading)
+        blobs  += [thumb,shading]
+        index[name] = info
+
+    header = json.dumps(index,sort_keys=True).encode('utf-8')
+    tmpName = os.path.join(directory,sidecarName+'.tmp')
+    with open(tmpName,'wb') as file:
+        file.write(b'LSPV'+struct.pack('<I',len(header))+header)
+        for blob in blobs:
+            file.write(blob)
+    os.rename(tmpName,os.path.join(directory,sidecarName))
+
+    print 'Indexed %d captures, %d decoded'%(len(index),decoded)
+    return index
+
+# captures suitable for calibration, best first: nothing
+# clipped, and all channels as equally well exposed as possible
+def calibration_candidates(index,maxClipped=0.0001):
+    names = [name for name,entry in index.items()
+             if max(entry['clipped'])<=maxClipped]
+    return sorted(names,key=lambda name:-index[name]['balance']*min(index[name]['level']))
+
+####### here the fun part starts! #####################################
+if __name__ == '__main__':
+
+    ####### Settings ##################
+
+    # directory with raw captures
+    archive  = 'archive'
+
+    # fill an empty archive with a few simulated captures
+    simulate = True
+
+    ###################################
+
+    if simulate:
+        from simcam import SimulatedCamera, create_shading
+        if not os.path.isdir(archive):
+            os.makedirs(archive)
+        for hflip,vflip,fileType in [(False,True,'B0'),(False,False,'B1'),
+                                     (True,False,'B2'),(True,True,'B3')]:
+            fileName = os.path.join(archive,'raw_'+fileType+'.jpg')
+            if os.path.exists(fileName):
+                continue
+            with SimulatedCamera(shading=create_shading(1.0+int(fileType[1]))) as camera:
+                camera.hflip = hflip
+                camera.vflip = vflip
+                camera.capture(fileName, format='jpeg', bayer=True)
+
+    index = update_index(archive)
+    for name in sorted(index):
+        entry = index[name]
+        print name,'bayerType',entry['bayerType'],'level',entry['level'],'clipped',max(entry['clipped'])
+
+    print 'Calibration candidates:',calibration_candidates(index)
+
+    # write out the thumbnails, just to have a look at them
+    for name in sorted(index):
+        cv2.imwrite(os.path.join(archive,'thumb_'+os.path.splitext(name)[0]+'.png'),
+                    read_thumbnail(archive,index[name]))
+
+    print
+    print '... done.'
@@ -0,0 +1,314 @@
+# for stream handling
+import io
+
+# for parsing the tables
+import re
+
+# need to wait a few secs
+from time import sleep
+
+# for some computations
+import cv2
+import numpy as np
+
+# This script refines an existing lens compensation table
+# (for example one computed by geo_05.py) in a closed loop:
+#
+#   1) apply the current table to the camera
+#   2) capture a normal (processed) image of the flat field
+#   3) measure the remaining non-uniformity at table resolution
+#   4) update the table multiplicatively and go back to 1)
+#
+# This corrects errors the one-shot computation from the raw
+# image can not see, as the lens shading is applied by the
+# firmware to the processed image only: the blocky upscaling
+# of the table and the rounding of the table entries.
+#
+# Every iteration is cheap: only a jpeg is captured (no
+# raw data), and that jpeg is decoded directly at 1/8 of its
+# resolution (the DCT-scaling of the jpeg-decoder does the
+# work here). At this scale, a table cell of 64x64 pixels is
+# just a block of 8x8 pixels. Usually, 2-3 iterations are
+# sufficient.
+#
+# Note: the jpeg contains only three colors, so both
+# green channels (Gr, Gb) are updated with the same residual.
+
+# size of a table cell in the jpeg decoded at 1/8 scale.
+# The table grid is defined on the full sensor (2592x1944
+# pixels, 64x64 pixels per table cell), so the camera
+# needs to capture at full resolution
+cellSize = 8
+
+# the orientation of a raw image (or a capture) with respect
+# to the lens compensation table - see calc_table() in geo_05.py.
+# Returns whether the x- and the y-axis are flipped. This
+# is also the side where the image needs to be padded
+# in order to map the table grid onto the image
+def orientation(bayerType):
+    # type 0: hflip = False, vflip = True
+    # type 1: hflip = False, vflip = False
+    # type 2: hflip = True,  vflip = False
+    # type 3: hflip = True,  vflip = True
+    flipX = bayerType in (0,1)
+    flipY = bayerType in (1,2)
+    return flipX, flipY
+
+# reduces an image (first index x, second index y, third
+# color channel - as in geo_05.py) to the resolution of
+# the lens compensation table, with cell x cell pixels
+# per table entry. Gives the same result as the padding and
+# iterative downsizing in calc_table(), but in a single
+# step. The result is in table format and orientation.
+def reduce_to_table(img,bayerType,cell):
+    flipX, flipY = orientation(bayerType)
+
+    # pad the image to a multiple of the cell size
+    nx    = img.shape[0]//cell+1
+    ny    = img.shape[1]//cell+1
+    pad_x = nx*cell-img.shape[0]
+    pad_y = ny*cell-img.shape[1]
+    top,bottom = (pad_x,0) if flipX else (0,pad_x)
+    left,right = (pad_y,0) if flipY else (0,pad_y)
+    tmpI  = cv2.copyMakeBorder(img.astype(np.float32),top,bottom,left,right,cv2.BORDER_REPLICATE)
+
+    # average over all pixels in a cell
+    cells = tmpI.reshape(nx,cell,ny,cell,img.shape[2]).mean(axis=(1,3))
+
+    # table format: color channel, y-coord, x-coord
+    table = cells.transpose(2,1,0)
+    if flipX:
+        table = table[:,:,::-1]
+    if flipY:
+        table = table[:,::-1,:]
+    return table
+
+# lookup table undoing the gamma of the processed image
+gamma     = 2.2
+linearize = np.power(np.arange(256)/255.0,gamma)
+
+# decodes just enough of a jpeg-capture to measure the
+# response of the camera at table resolution. Returns the
+# linear response per table cell and channel, as well as
+# the fraction of saturated pixels in every cell
+def measure(data,bayerType):
+    img = cv2.imdecode(np.frombuffer(data,dtype=np.uint8),cv2.IMREAD_REDUCED_COLOR_8)
+
+    # some OpenCV-versions ignore the reduced-flag
+    # in imdecode - than we need to downsize ourselves
+    if img.shape[:2]==(1944,2592):
+        img = cv2.resize(img,(2592//8,1944//8),interpolation=cv2.INTER_AREA)
+    if img.shape[:2]!=(1944//8,2592//8):
+        raise ValueError('capture at full sensor resolution (2592x1944) - '
+                         'decoded jpeg has %dx%d pixels'%(img.shape[1],img.shape[0]))
+
+    # BGR [y,x] -> R,Gr,Gb,B [x,y]
+    img = img.transpose(1,0,2)
+    lin = linearize[img]
+    cplane = np.dstack((lin[:,:,2],lin[:,:,1],lin[:,:,1],lin[:,:,0]))
+    saturated = (img[:,:,::-1]>=250)[:,:,(0,1,1,2)]
+
+    response = reduce_to_table(cplane,bayerType,cellSize)
+    clipped  = reduce_to_table(saturated,bayerType,cellSize)
+    return response, clipped
+
+# non-uniformity of the response (relative standard
+# deviation) per color channel, only counting valid cells
+def flatness(response,valid):
+    result = np.full(response.shape[0],np.inf)
+    for c in range(0,response.shape[0]):
+        values = response[c][valid[c]]
+        if values.size>1:
+            result[c] = values.std()/values.mean()
+    return result
+
+# the gains which would flatten the measured response: every
+# cell of the table is scaled by the ratio of the mean response
+# and its own response. Afterwards, each channel is normalized
+# again such that its smallest gain equals scaler (so that no
+# gains below 1.0 are requested). Cells which were saturated
+# in the capture are only scaled down. Returns float values,
+# limited to the range of the table entries (max. 8x gain)
+def target_gains(table,response,valid,alpha,scaler):
+    table = table.astype(float)
+    for c in range(0,table.shape[0]):
+        # nothing to measure - all saturated
+        if not valid[c].any():
+            continue
+        ref   = response[c][valid[c]].mean()
+        ratio = np.divide(ref,response[c],out=np.ones_like(response[c]),where=response[c]>0)
+        ratio[~valid[c]] = np.minimum(ratio[~valid[c]],1.0)
+        table[c] *= np.power(ratio,alpha)
+        table[c] *= float(scaler)/table[c].min()
+    return table.clip(0x00,0xff)
+
+# multiplicative update of the table, rounded to table entries
+def update_table(table,response,valid,alpha,scaler):
+    return (target_gains(table,response,valid,alpha,scaler)+0.5).astype(np.uint8)
+
+# the actual refinement loop. The camera should be set up
+# already (orientation, exposure and whitebalance locked).
+# Stops if the non-uniformity drops below tolerance or if
+# the iteration budget is used up, and returns the best
+# table found along with its non-uniformity
+def refine_table(camera,table,bayerType,iterations=3,tolerance=0.01,
+                 alpha=1.0,scaler=32,settle=0.5):
+    best     = None
+    bestFlat = np.inf
+
+    for iteration in range(0,iterations+1):
+        # apply the current table and capture
+        camera.lens_shading_table = table
+        sleep(settle)
+        stream = io.BytesIO()
+        camera.capture(stream, format='jpeg')
+
+        # measure residual non-uniformity
+        response, clipped = measure(stream.getvalue(),bayerType)
+        valid = clipped<0.01
+        flat  = flatness(response,valid)
+        nClip = np.count_nonzero(table==0xff)
+        print 'Iteration %d: non-uniformity R %.4f Gr/Gb %.4f B %.4f, %d entries at 255' \
+              %(iteration,flat[0],flat[1],flat[3],nClip)
+
+        # keep track of the best table - the last one
+        # measured is not necessarily the best
+        if flat.max()<bestFlat:
+            best     = table
+            bestFlat = flat.max()
+
+        if flat.max()<=tolerance or iteration==iterations:
+            break
+
+        table = update_table(table,response,valid,alpha,scaler)
+
+    return best, bestFlat
+
+# simple routine for saving the calculated
+# lens compensation table in human-readable
+# form. In fact, it is the .h-format the
+# C-program for lens shading correction is
+# expecting as input at compilation time
+def save_table(filename,table):
+    # the ls_table.h has the following sequence of channels
+    cComments = ["R",
+                "Gr",
+                "Gb",
+                "B"]
+
+    # now write the table...
+    with open(filename,'w') as file:
+
+        # initial part of the table
+        file.write("uint8_t ls_grid[] = {\n")
+
+        for c in range(0,4):
+            # insert channel comment (for readability)
+            file.write("//%s - Ch %d\n"%(cComments[c],3-c))
+            # scan the table, a line at a time
+            for line in np.asarray(table[c],dtype=int).tolist():
+                file.write(", ".join(map(str,line))+",\n")
+
+        # finish the the ls_grid array
+        file.write("};\n");
+
+        # write some additional vars which are expected in ls_table.h
+        file.write("uint32_t ref_transform = 3;\n");
+        file.write("uint32_t grid_width = %u;\n"%table.shape[1]);
+        file.write("uint32_t grid_height = %u;\n"%table.shape[2]);
+
+# fast reader for a table stored as .h-file: the numbers
+# between the braces are parsed by numpy in a single call
+def read_table(inFile):
+    with open(inFile) as file:
+        text = file.read()
+
+    grid = dict(re.findall(r'uint32_t (grid_width|grid_height) = (\d+);',text))
+    body = text[text.index('{')+1:text.index('}')]
+    body = re.sub(r'//[^\n]*','',body).rstrip().rstrip(',')
+    values = np.fromstring(body,dtype=np.int32,sep=',')
+
+    # grid_width holds the number of rows, grid_height
+    # the number of columns - see save_table()
+    return values.reshape(-1,int(grid['grid_width']),int(grid['grid_height'])).astype(np.uint8)
+
+####### here the fun part starts! #####################################
+if __name__ == '__main__':
+
+    ####### Settings ##################
+
+    # use the simulated camera instead of the real one
+    simulate   = True
+
+    # start from a table computed by geo_05.py - if None,
+    # the refinement starts from a flat table
+    startName  = None
+
+    # camera orientation
+    hflip      = True
+    vflip      = True
+
+    # iteration budget, target non-uniformity and
+    # damping of the update
+    iterations = 3
+    tolerance  = 0.01
+    alpha      = 1.0
+
+    # gain of the brightest cell (32 = 1.0)
+    scaler     = 32
+
+    ###################################
+
+    if simulate:
+        from simcam import SimulatedCamera as Camera
+        settle = 0
+    else:
+        from picamera import PiCamera as Camera
+        settle = 0.5
+
+    if   hflip==True and vflip==True:
+        fileType, bayerType = 'B3', 3
+    elif hflip==False and vflip==True:
+        fileType, bayerType = 'B0', 0
+    elif hflip==True and vflip==False:
+        fileType, bayerType = 'B2', 2
+    else:
+        fileType, bayerType = 'B1', 1
+
+    if startName:
+        table = read_table(startName)
+    else:
+        table = np.full((4,31,41),scaler,dtype=np.uint8)
+    print 'Starting with table',table.shape,table.dtype
+
+    with Camera(lens_shading_table=table) as camera:
+
+        # the measurement assumes that the full sensor is captured
+        camera.sensor_mode = 2
+        camera.resolution  = (2592,1944)
+        camera.hflip       = hflip
+        camera.vflip       = vflip
+
+        # Let the camera warm up for a couple of seconds,
+        # than freeze exposure and whitebalance - otherwise
+        # the camera would fight against our table updates
+        print 'Setting up camera. Wait a few sec...'
+        camera.awb_mode = 'auto'
+        sleep(2*settle)
+        camera.shutter_speed = camera.exposure_speed
+        camera.exposure_mode = 'off'
+        awb_gains = camera.awb_gains
+        camera.awb_mode  = 'off'
+        camera.awb_gains = awb_gains
+
+        table, flat = refine_table(camera,table,bayerType,iterations,tolerance,
+                                   alpha,scaler,settle)
+
+    print 'Best non-uniformity: %.4f'%flat
+
+    tableName = 'table_'+fileType+'_refined.h'
+    print 'Saving table as',tableName
+    save_table(tableName,table)
+
+    print
+    print '... done.'
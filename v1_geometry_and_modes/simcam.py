@@ -0,0 +1,253 @@
+# a simulated v1-camera, mimicking the small part of the
+# picamera-interface (rwb27 version) the scripts in this
+# directory are using. It allows to try out the table
+# computations without a Raspberry Pi attached.
+#
+# The simulation works on the half-resolution color planes
+# (one value per Bayer quad, 1296x972) in the reference
+# orientation of the lens compensation table (which is
+# the orientation of a raw image taken with hflip = True
+# and vflip = True, "bayerType 3").
+#
+# What is modelled:
+# - a lens with vignetting and a slight color cast towards
+#   the edges, different for each color channel
+# - an (optional) non-uniform scene in front of the camera
+# - exposure time and analog gain, the black level of the raw data
+# - the raw Bayer data appended to a jpeg-capture (bayer=True),
+#   packed exactly like the v1-camera does it, with the
+#   Bayer order changing with the hflip/vflip settings
+# - the lens shading table, which acts only on the processed
+#   image (jpeg, rgb), never on the raw data. The table is
+#   upscaled in a blocky way: every table cell is simply
+#   replicated over its 64x64 pixel tile, and the tile grid
+#   is slightly shifted against the grid the table was
+#   computed for - which is roughly what the firmware seems to do
+# - the gamma curve of the processed image
+
+# for some computations
+import cv2
+import numpy as np
+
+# structure of the raw image header
+# from https://picamera.readthedocs.io/en/release-1.13/_modules/picamera/array.html#PiBayerArray
+import ctypes as ct
+class BroadcomRawHeader(ct.Structure):
+    _fields_ = [
+        ('name',          ct.c_char * 32),
+        ('width',         ct.c_uint16),
+        ('height',        ct.c_uint16),
+        ('padding_right', ct.c_uint16),
+        ('padding_down',  ct.c_uint16),
+        ('dummy',         ct.c_uint32 * 6),
+        ('transform',     ct.c_uint16),
+        ('format',        ct.c_uint16),
+        ('bayer_order',   ct.c_uint8),
+        ('bayer_format',  ct.c_uint8),
+        ]
+
+# size of the half-resolution color planes of the v1-sensor
+planeWidth  = 1296
+planeHeight = 972
+
+# size of a table cell in units of the color planes
+# (a table cell covers 64x64 sensor pixels)
+cellSize    = 32
+
+# gamma used for the processed images
+gamma       = 2.2
+
+# the bayerType which is reported by the camera for
+# the different hflip/vflip settings
+def bayer_type(hflip,vflip):
+    if   hflip==True and vflip==True:
+        return 3
+    elif hflip==False and vflip==True:
+        return 0
+    elif hflip==True and vflip==False:
+        return 2
+    else:
+        return 1
+
+# default lens of the simulation: vignetting
+# which is not centered on the sensor, with
+# slightly different strength in every color
+# channel (Ch 0: Red, 1: Gr, 2: Gb, 3: Blue)
+def create_shading(strength=1.0):
+    y,x = np.mgrid[0:planeHeight,0:planeWidth].astype(float)
+
+    # normalized coordinates, optical center a little
+    # bit off towards the upper right of the sensor
+    u = (x-0.55*planeWidth)/(0.5*planeWidth)
+    v = (y-0.45*planeHeight)/(0.5*planeWidth)
+    r2 = u*u+v*v
+
+    shading = np.zeros((planeHeight,planeWidth,4))
+    for c,k in enumerate([0.90,0.60,0.65,1.20]):
+        shading[:,:,c] = 1.0/(1.0+strength*k*r2)
+    return shading
+
+class SimulatedCamera(object):
+
+    # exposure time [us] which gives a full scale
+    # signal for a white scene at the optical center
+    fullScale = 20000
+
+    def __init__(self,lens_shading_table=None,shading=None,scene=None,
+                 upscale_shift=8,noise=0.004,black_level=16,seed=None):
+        # the settings also found in PiCamera
+        self.resolution         = (2592,1944)
+        self.sensor_mode        = 0
+        self.hflip              = False
+        self.vflip              = False
+        self.awb_mode           = 'auto'
+        self._awb_gains         = (1.0,1.0)
+        self.exposure_mode      = 'auto'
+        self.shutter_speed      = 0
+        self.analog_gain        = 1.0
+        self.lens_shading_table = lens_shading_table
+
+        # parameters of the simulation
+        if shading is None:
+            shading = create_shading()
+        self.shading       = shading
+        self.scene         = scene
+        self.upscale_shift = upscale_shift
+        self.noise         = noise
+        self.black_level   = black_level
+        self.random        = np.random.RandomState(seed)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self,*args):
+        self.close()
+
+    def close(self):
+        pass
+
+    # in auto-mode, the whitebalance makes the
+    # average of the scene gray
+    @property
+    def awb_gains(self):
+        if self.awb_mode=='auto':
+            mean = self.sensor_signal(self.fullScale).mean(axis=(0,1))
+            return (0.5*(mean[1]+mean[2])/mean[0],0.5*(mean[1]+mean[2])/mean[3])
+        return self._awb_gains
+
+    @awb_gains.setter
+    def awb_gains(self,gains):
+        self._awb_gains = gains
+
+    @property
+    def exposure_speed(self):
+        # in auto-mode, we expose such that the brightest
+        # part of the processed image ends up at about 80% full scale
+        if self.shutter_speed==0:
+            red,blue = self.awb_gains
+            peak = (self.sensor_signal(self.fullScale)*[red,1.0,1.0,blue]).max()
+            return int(0.8*self.fullScale/peak)
+        return self.shutter_speed
+
+    # the linear signal on the sensor (0..1 = full scale of
+    # the 10 bit converter), in reference orientation
+    def sensor_signal(self,exposure):
+        signal = self.shading*(self.analog_gain*float(exposure)/self.fullScale)
+        if self.scene is not None:
+            signal *= self.scene[:,:,np.newaxis]
+        return signal
+
+    # the gains the firmware applies - the table is
+    # replicated cell by cell, on a slightly shifted grid
+    def shading_gains(self):
+        if self.lens_shading_table is None:
+            return np.ones((planeHeight,planeWidth,4))
+        table = np.asarray(self.lens_shading_table,dtype=float)/32.0
+
+        iy = np.clip((np.arange(planeHeight)+self.upscale_shift)//cellSize,0,table.shape[1]-1)
+        ix = np.clip((np.arange(planeWidth) +self.upscale_shift)//cellSize,0,table.shape[2]-1)
+        return table[:,iy,:][:,:,ix].transpose(1,2,0)
+
+    # flips an image in reference orientation into the
+    # orientation requested by the hflip/vflip settings
+    def orient(self,img):
+        if not self.hflip:
+            img = img[:,::-1]
+        if not self.vflip:
+            img = img[::-1]
+        return img
+
+    def capture(self,output,format='jpeg',bayer=False,use_video_port=False,quality=85):
+        signal = self.sensor_signal(self.exposure_speed)
+        signal = signal*(1.0+self.noise*self.random.standard_normal(signal.shape))
+
+        # the processed image: lens shading, white balance, gamma
+        proc = signal*self.shading_gains()
+        red,blue = self.awb_gains
+        rgb  = np.dstack((red*proc[:,:,0],0.5*(proc[:,:,1]+proc[:,:,2]),blue*proc[:,:,3]))
+        rgb  = np.power(rgb.clip(0.0,1.0),1.0/gamma)
+        rgb  = cv2.resize(np.ascontiguousarray(self.orient(rgb)),self.resolution,interpolation=cv2.INTER_LINEAR)
+        bgr  = (255.0*rgb[:,:,::-1]+0.5).astype(np.uint8)
+
+        if format=='jpeg':
+            ok,buf = cv2.imencode('.jpg',bgr,[cv2.IMWRITE_JPEG_QUALITY,quality])
+            data = buf.tostring()
+            if bayer:
+                data += self.raw_data(signal)
+        elif format=='bgr':
+            data = bgr.tostring()
+        elif format=='rgb':
+            data = bgr[:,:,::-1].tostring()
+        else:
+            raise ValueError('Unsupported format: %s'%format)
+
+        # output can be either a filename or a stream
+        if hasattr(output,'write'):
+            output.write(data)
+        else:
+            with open(output,'wb') as file:
+                file.write(data)
+
+    # the raw Bayer data, as appended by the v1-camera
+    # to a jpeg-capture (6404096 bytes, header included)
+    def raw_data(self,signal):
+        bayerType = bayer_type(self.hflip,self.vflip)
+
+        # 10 bit values of the color planes, in the
+        # orientation of the raw image. Again, as in the
+        # readRaw()-routines, first index is x, second y
+        black  = self.black_level
+        cplane = (black+(1023.0-black)*self.orient(signal).clip(0.0,1.0)+0.5).astype(np.uint16)
+        cplane = cplane.transpose(1,0,2)
+
+        # mosaic the color planes into the Bayer pattern,
+        # just the inverse of the readRaw()-routines
+        data  = np.zeros((2*planeWidth,2*planeHeight),dtype=np.uint16)
+        order = {0:(0,1,2,3),1:(1,0,3,2),2:(3,2,1,0),3:(2,3,0,1)}[bayerType]
+        data[0::2, 0::2] = cplane[:,:,order[0]]
+        data[0::2, 1::2] = cplane[:,:,order[1]]
+        data[1::2, 0::2] = cplane[:,:,order[2]]
+        data[1::2, 1::2] = cplane[:,:,order[3]]
+        data = data.transpose()
+
+        # pack 4 pixels into 5 bytes: first the upper 8 bits
+        # of every pixel, than a byte with the remaining bits
+        packed = np.zeros((1952,3264),dtype=np.uint8)
+        packed[:1944,0:3240:5] = data[:,0::4] >> 2
+        packed[:1944,1:3240:5] = data[:,1::4] >> 2
+        packed[:1944,2:3240:5] = data[:,2::4] >> 2
+        packed[:1944,3:3240:5] = data[:,3::4] >> 2
+        packed[:1944,4:3240:5] = (((data[:,0::4] & 0b11) << 6) | ((data[:,1::4] & 0b11) << 4)
+                                 |((data[:,2::4] & 0b11) << 2) |  (data[:,3::4] & 0b11))
+
+        header = BroadcomRawHeader()
+        header.name        = b'SIMULATED'
+        header.width       = 2592
+        header.height      = 1944
+        header.bayer_order = bayerType
+        header.bayer_format= 33
+
+        raw = bytearray(32768)
+        raw[0:4] = b'BRCM'
+        raw[176:176+ct.sizeof(header)] = bytearray(header)
+        return bytes(raw)+packed.tostring()
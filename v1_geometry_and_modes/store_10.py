@@ -0,0 +1,271 @@
+# for the store file
+import os
+import struct
+import zlib
+
+# for some computations
+import numpy as np
+
+# collecting the tables and the table output
+from fleet_09 import load_tables
+from refine_06 import save_table
+
+# This script keeps the lens compensation tables of many
+# devices in a single, compact store file. Tables of devices
+# with the same lens model differ only by a few LSBs per cell,
+# so the store keeps one base table per lens model and every
+# device table as the difference to that base.
+#
+# Each difference is encoded on its own:
+# - optionally as the difference between neighbouring cells
+#   along the x-axis, if the differences to the base are
+#   smooth (a slightly different overall gain, for example)
+# - mapped to small positive numbers (zigzag: 0,-1,1,-2,2...)
+#   so that nearly all entries fit into a single byte
+# - compressed with zlib (deflate, which includes Huffman-
+#   coding of the mostly very small values)
+#
+# A device only needs its base table once - after that,
+# a table update is just the encoded difference, usually a
+# tiny fraction of the 20 KB of the .h-file.
+#
+# Store file layout (all numbers little endian):
+#   'LSDS', version (uint8), table shape (3 x uint16)
+#   number of models (uint32), per model: name, base table
+#   number of tables (uint32), per table: name, model (uint16),
+#       mode (uint8), offset and length of the data (uint32)
+#   the encoded differences, one after the other
+# Names are stored as uint16 length followed by utf-8 bytes.
+
+# version of the store file format
+storeVersion = 1
+
+# bits of the mode byte
+modeDPCM   = 0b01
+mode16Bits = 0b10
+
+# zigzag-mapping of signed differences to unsigned numbers
+def zigzag(delta):
+    return ((delta << 1) ^ (delta >> 15)).astype(np.uint16)
+
+def unzigzag(values):
+    values = values.astype(np.int16)
+    return (values >> 1) ^ -(values & 1)
+
+# encodes the difference of a table to its base. Tries both
+# the plain and the x-differenced version, keeps the smaller
+def encode_delta(table,base):
+    delta = table.astype(np.int16)-base.astype(np.int16)
+    best  = None
+    for mode in (0,modeDPCM):
+        values = delta
+        if mode & modeDPCM:
+            values = np.concatenate((delta[...,:1],np.diff(delta,axis=-1)),axis=-1)
+        values = zigzag(values)
+        if values.max()<0x100:
+            values = values.astype(np.uint8)
+        else:
+            mode |= mode16Bits
+        data = zlib.compress(values.tostring(),9)
+        if best is None or len(data)<len(best[1]):
+            best = (mode,data)
+    return best
+
+# decodes a single difference and adds it to the base
+def decode_delta(mode,data,base):
+    dtype  = np.uint16 if mode & mode16Bits else np.uint8
+    values = unzigzag(np.frombuffer(zlib.decompress(data),dtype=dtype).reshape(base.shape))
+    if mode & modeDPCM:
+        values = np.cumsum(values,axis=-1)
+    return (base.astype(np.int16)+values).clip(0x00,0xff).astype(np.uint8)
+
+# an update packet for a device which already has the
+# base table of its lens model: the mode byte and the data
+def delta_packet(mode,data):
+    return struct.pack('<B',mode)+data
+
+def apply_packet(packet,base):
+    mode, = struct.unpack('<B',packet[:1])
+    return decode_delta(mode,packet[1:],base)
+
+class TableStore(object):
+
+    def __init__(self,shape=(4,31,41)):
+        self.shape   = shape
+        self.models  = []
+        self.bases   = []
+        # name -> (model index, mode, encoded difference)
+        self.entries = {}
+
+    # base tables and models
+    def add_model(self,model,base):
+        self.models.append(model)
+        self.bases.append(np.asarray(base,dtype=np.uint8))
+        return len(self.models)-1
+
+    def base(self,model):
+        return self.bases[self.models.index(model)]
+
+    # storing and retrieving single tables
+    def put(self,name,model,table):
+        m = self.models.index(model)
+        mode, data = encode_delta(table,self.bases[m])
+        self.entries[name] = (m,mode,data)
+
+    def get(self,name):
+        m, mode, data = self.entries[name]
+        return decode_delta(mode,data,self.bases[m])
+
+    def packet(self,name):
+        m, mode, data = self.entries[name]
+        return delta_packet(mode,data)
+
+    def names(self):
+        return sorted(self.entries)
+
+    # reconstructs many tables at once. Only the decompression
+    # is done per table, everything else on the whole stack
+    def get_many(self,names):
+        entries = [self.entries[name] for name in names]
+        models  = np.array([m for m,mode,data in entries],dtype=int)
+        modes   = np.array([mode for m,mode,data in entries],dtype=int)
+
+        values = np.empty((len(names),)+tuple(self.shape),dtype=np.int16)
+        wide   = (modes & mode16Bits)!=0
+        for i,(m,mode,data) in enumerate(entries):
+            dtype = np.uint16 if wide[i] else np.uint8
+            values[i] = np.frombuffer(zlib.decompress(data),dtype=dtype).reshape(self.shape)
+
+        values = unzigzag(values)
+        dpcm   = (modes & modeDPCM)!=0
+        values[dpcm] = np.cumsum(values[dpcm],axis=-1)
+
+        bases  = np.array(self.bases,dtype=np.int16)
+        return (bases[models]+values).clip(0x00,0xff).astype(np.uint8)
+
+    # bulk import of all tables below root, which belong to
+    # the given lens model. The base table of a new model is
+    # the median of all its tables
+    def import_tables(self,root,model):
+        tables, files, devices, types = load_tables(root)
+        if len(files)==0:
+            raise ValueError('no tables found below %s'%root)
+        if model not in self.models:
+            self.add_model(model,np.round(np.median(tables,axis=0)))
+        for table,name in zip(tables,files):
+            self.put(model+'/'+os.path.relpath(name,root),model,table)
+        return len(files)
+
+    # bulk export of all tables as .h-files below root
+    def export_tables(self,root):
+        names = self.names()
+        for name,table in zip(names,self.get_many(names)):
+            fileName = os.path.join(root,*name.split('/'))
+            if not os.path.isdir(os.path.dirname(fileName)):
+                os.makedirs(os.path.dirname(fileName))
+            save_table(fileName,table)
+        return len(names)
+
+    # the store file
+    def save(self,fileName):
+        def packName(name):
+            name = name.encode('utf-8')
+            return struct.pack('<H',len(name))+name
+
+        header = [b'LSDS',struct.pack('<B3H',storeVersion,*self.shape),
+                  struct.pack('<I',len(self.models))]
+        for model,base in zip(self.models,self.bases):
+            header += [packName(model),base.tostring()]
+
+        names  = self.names()
+        index  = [struct.pack('<I',len(names))]
+        offset = 0
+        for name in names:
+            m, mode, data = self.entries[name]
+            index += [packName(name),struct.pack('<HBII',m,mode,offset,len(data))]
+            offset += len(data)
+
+        with open(fileName,'wb') as file:
+            file.write(b''.join(header+index))
+            for name in names:
+                file.write(self.entries[name][2])
+
+    @classmethod
+    def load(cls,fileName):
+        with open(fileName,'rb') as file:
+            data = file.read()
+
+        def unpack(fmt,pos):
+            values = struct.unpack_from(fmt,data,pos)
+            return values, pos+struct.calcsize(fmt)
+        def unpackName(pos):
+            (size,), pos = unpack('<H',pos)
+            return data[pos:pos+size].decode('utf-8'), pos+size
+
+        assert data[:4]==b'LSDS', 'not a table store'
+        (version,nz,ny,nx), pos = unpack('<B3H',4)
+        if version!=storeVersion:
+            raise ValueError('unknown table store version %d'%version)
+        store = cls((nz,ny,nx))
+        size  = nz*ny*nx
+
+        (nModels,), pos = unpack('<I',pos)
+        for i in range(0,nModels):
+            model, pos = unpackName(pos)
+            base = np.frombuffer(data[pos:pos+size],dtype=np.uint8).reshape(store.shape)
+            store.add_model(model,base)
+            pos += size
+
+        (nTables,), pos = unpack('<I',pos)
+        index = []
+        for i in range(0,nTables):
+            name, pos = unpackName(pos)
+            (m,mode,offset,length), pos = unpack('<HBII',pos)
+            index.append((name,m,mode,offset,length))
+        for name,m,mode,offset,length in index:
+            store.entries[name] = (m,mode,data[pos+offset:pos+offset+length])
+        return store
+
+####### here the fun part starts! #####################################
+if __name__ == '__main__':
+
+    ####### Settings ##################
+
+    # the lens models to import: model name -> directory
+    # with the tables of all devices with that lens
+    models    = { 'componon50': 'example_results' }
+
+    # the store file
+    storeName = 'tables.lsds'
+
+    # set to a directory to write all tables back as .h-files
+    exportDir = None
+
+    ###################################
+
+    store = TableStore()
+    hSize = 0
+    for model in sorted(models):
+        count = store.import_tables(models[model],model)
+        hSize += sum(os.path.getsize(os.path.join(path,name))
+                     for path,dirs,files in os.walk(models[model])
+                     for name in files if name.startswith('table_') and name.endswith('.h'))
+        print 'Imported',count,'tables of lens model',model
+    store.save(storeName)
+
+    # check that everything comes back unchanged
+    store  = TableStore.load(storeName)
+    names  = store.names()
+    tables = store.get_many(names)
+    for name,table in zip(names,tables):
+        assert (table==store.get(name)).all()
+
+    packets = sum(len(store.packet(name)) for name in names)
+    print 'Size of .h-files: %d bytes, store: %d bytes, update packets: %d bytes'\
+          %(hSize,os.path.getsize(storeName),packets)
+
+    if exportDir:
+        print 'Exported',store.export_tables(exportDir),'tables to',exportDir
+
+    print
+    print '... done.'